@@ -10,12 +10,12 @@ from gnomad.utils.annotations import (
     get_adj_expr,
     get_lowqual_expr,
 )
-from gnomad.utils.filtering import filter_to_autosomes
 from gnomad.utils.slack import slack_notifications
 from gnomad.utils.sparse_mt import (
     get_as_info_expr,
     get_site_info_expr,
     INFO_INT32_SUM_AGG_FIELDS,
+    INFO_MEDIAN_AGG_FIELDS,
     INFO_SUM_AGG_FIELDS,
     split_info_annotation,
     split_lowqual_annotation,
@@ -43,6 +43,23 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Note that production defaults have changed:
+# For new releases, the `RAWMQ_andDP` field replaces the `RAW_MQ` and `MQ_DP` fields
+INFO_SUM_FIELDS = INFO_SUM_AGG_FIELDS + ["RAW_MQ"]
+"""
+Fields summed as floats when computing the site and allele-specific info fields in `compute_info`.
+"""
+
+INFO_INT32_SUM_FIELDS = INFO_INT32_SUM_AGG_FIELDS + ["MQ_DP"]
+"""
+Fields summed as int32 when computing the site and allele-specific info fields in `compute_info`.
+"""
+
+INFO_ARRAY_SUM_FIELDS = ["SB"]
+"""
+Array fields summed element-wise when computing the site and allele-specific info fields in `compute_info`.
+"""
+
 
 def compute_info() -> hl.Table:
     """
@@ -58,65 +75,91 @@ def compute_info() -> hl.Table:
     )
 
     mt = mt.filter_rows((hl.len(mt.alleles) > 1))
-    mt = mt.transmute_entries(**mt.gvcf_info)
+
+    # Drop the entry fields that are not needed for the info computation before unpacking gvcf_info
+    info_entry_fields = {"LA", "LGT", "LAD", "GQ", "DP", "SB", "gvcf_info"}
+    mt = mt.select_entries(*[f for f in mt.entry if f in info_entry_fields])
+    # Only unpack the gvcf_info fields (or their allele-specific versions) that are aggregated into the info fields
+    gvcf_info_fields = set(
+        INFO_SUM_FIELDS
+        + INFO_INT32_SUM_FIELDS
+        + INFO_ARRAY_SUM_FIELDS
+        + INFO_MEDIAN_AGG_FIELDS
+    )
+    mt = mt.transmute_entries(
+        **{
+            f: mt.gvcf_info[f]
+            for f in mt.gvcf_info
+            if f in gvcf_info_fields
+            or (f.startswith("AS_") and f[len("AS_") :] in gvcf_info_fields)
+        }
+    )
     mt = mt.annotate_rows(alt_alleles_range_array=hl.range(1, hl.len(mt.alleles)))
 
     # Compute AS and site level info expr
-    # Note that production defaults have changed:
-    # For new releases, the `RAWMQ_andDP` field replaces the `RAW_MQ` and `MQ_DP` fields
     info_expr = get_site_info_expr(
         mt,
-        sum_agg_fields=INFO_SUM_AGG_FIELDS + ["RAW_MQ"],
-        int32_sum_agg_fields=INFO_INT32_SUM_AGG_FIELDS + ["MQ_DP"],
-        array_sum_agg_fields=["SB"],
+        sum_agg_fields=INFO_SUM_FIELDS,
+        int32_sum_agg_fields=INFO_INT32_SUM_FIELDS,
+        array_sum_agg_fields=INFO_ARRAY_SUM_FIELDS,
     )
     info_expr = info_expr.annotate(
         **get_as_info_expr(
             mt,
-            sum_agg_fields=INFO_SUM_AGG_FIELDS + ["RAW_MQ"],
-            int32_sum_agg_fields=INFO_INT32_SUM_AGG_FIELDS + ["MQ_DP"],
-            array_sum_agg_fields=["SB"],
+            sum_agg_fields=INFO_SUM_FIELDS,
+            int32_sum_agg_fields=INFO_INT32_SUM_FIELDS,
+            array_sum_agg_fields=INFO_ARRAY_SUM_FIELDS,
         )
     )
 
     # Add AC and AC_raw:
-    # First compute ACs for each non-ref allele, grouped by adj
-    grp_ac_expr = hl.agg.array_agg(
-        lambda ai: hl.agg.filter(
-            mt.LA.contains(ai),
-            hl.agg.group_by(
-                get_adj_expr(mt.LGT, mt.GQ, mt.DP, mt.LAD),
-                hl.agg.sum(
-                    mt.LGT.one_hot_alleles(mt.LA.map(lambda x: hl.str(x)))[
-                        mt.LA.index(ai)
-                    ]
-                ),
-            ),
+    # First count the global alt alleles carried by each call, grouped by adj.
+    # Mapping the called local alleles through LA keeps the per-entry work proportional to the ploidy
+    grp_ac_expr = hl.agg.group_by(
+        get_adj_expr(mt.LGT, mt.GQ, mt.DP, mt.LAD),
+        hl.agg.explode(
+            lambda ai: hl.agg.counter(ai),
+            hl.range(mt.LGT.ploidy)
+            .map(lambda i: mt.LA[mt.LGT[i]])
+            .filter(lambda ai: ai > 0),
         ),
-        mt.alt_alleles_range_array,
     )
 
     # Then, for each non-ref allele, compute
     # AC as the adj group
     # AC_raw as the sum of adj and non-adj groups
+    no_ac_expr = hl.empty_dict(hl.tint32, hl.tint64)
     info_expr = info_expr.annotate(
-        AC_raw=grp_ac_expr.map(lambda i: hl.int32(i.get(True, 0) + i.get(False, 0))),
-        AC=grp_ac_expr.map(lambda i: hl.int32(i.get(True, 0))),
+        AC_raw=mt.alt_alleles_range_array.map(
+            lambda ai: hl.int32(
+                grp_ac_expr.get(True, no_ac_expr).get(ai, 0)
+                + grp_ac_expr.get(False, no_ac_expr).get(ai, 0)
+            )
+        ),
+        AC=mt.alt_alleles_range_array.map(
+            lambda ai: hl.int32(grp_ac_expr.get(True, no_ac_expr).get(ai, 0))
+        ),
     )
 
     # Annotating raw MT with pab max
-    info_expr = info_expr.annotate(
-        AS_pab_max=hl.agg.array_agg(
-            lambda ai: hl.agg.filter(
-                mt.LA.contains(ai) & mt.LGT.is_het(),
-                hl.agg.max(
-                    hl.binom_test(
-                        mt.LAD[mt.LA.index(ai)], hl.sum(mt.LAD), 0.5, "two-sided"
-                    )
-                ),
+    # The pab max is first grouped by global alt allele, iterating over the local alt alleles of each het call,
+    # and then scattered back onto the alt allele range
+    grp_pab_max_expr = hl.agg.filter(
+        mt.LGT.is_het(),
+        hl.agg.explode(
+            lambda x: hl.agg.group_by(x[0], hl.agg.max(x[1])),
+            hl.range(1, hl.len(mt.LA)).map(
+                lambda li: hl.tuple(
+                    [
+                        mt.LA[li],
+                        hl.binom_test(mt.LAD[li], hl.sum(mt.LAD), 0.5, "two-sided"),
+                    ]
+                )
             ),
-            mt.alt_alleles_range_array,
-        )
+        ),
+    )
+    info_expr = info_expr.annotate(
+        AS_pab_max=mt.alt_alleles_range_array.map(lambda ai: grp_pab_max_expr.get(ai))
     )
 
     info_ht = mt.select_rows(info=info_expr).rows()
@@ -170,7 +213,7 @@ def generate_allele_data(ht: hl.Table) -> hl.Table:
     """
     ht = ht.select()
     allele_data = hl.struct(
-        nonsplit_alleles=ht.alleles, has_star=hl.any(lambda a: a == "*", ht.alleles)
+        nonsplit_alleles=ht.alleles, has_star=ht.alleles.contains("*")
     )
     ht = ht.annotate(allele_data=allele_data.annotate(**add_variant_type(ht.alleles)))
 
@@ -203,31 +246,46 @@ def generate_ac(mt: hl.MatrixTable) -> hl.Table:
         - `ac_qc_samples_unrelated_adj`: Allele count of high quality unrelated samples after adj filtering
         - `ac_release_samples_adj`: Allele count of release samples after adj filtering
 
-    :param mt: Input MatrixTable
+    :param mt: Input split MatrixTable with sample metadata
     :return: Table containing allele counts
     """
     mt = mt.filter_cols(mt.meta.high_quality)
     mt = mt.filter_rows(hl.len(mt.alleles) > 1)
     mt = annotate_adj(mt)
+
+    # Sum alt alleles once per row, grouped by every combination of unrelated/release/adj status,
+    # so that all six ACs below come from a single pass over the entries
     mt = mt.annotate_rows(
-        ac_qc_samples_raw=hl.agg.sum(mt.GT.n_alt_alleles()),
-        ac_qc_samples_unrelated_raw=hl.agg.filter(
-            ~mt.meta.sample_filters.all_samples_related,
-            hl.agg.sum(mt.GT.n_alt_alleles()),
-        ),
-        ac_release_samples_raw=hl.agg.filter(
-            mt.meta.release, hl.agg.sum(mt.GT.n_alt_alleles())
-        ),
-        ac_qc_samples_adj=hl.agg.filter(mt.adj, hl.agg.sum(mt.GT.n_alt_alleles())),
-        ac_qc_samples_unrelated_adj=hl.agg.filter(
-            ~mt.meta.sample_filters.all_samples_related & mt.adj,
+        _ac_strata=hl.agg.group_by(
+            hl.struct(
+                unrelated=hl.or_else(
+                    ~mt.meta.sample_filters.all_samples_related, False
+                ),
+                release=hl.or_else(mt.meta.release, False),
+                adj=hl.or_else(mt.adj, False),
+            ),
             hl.agg.sum(mt.GT.n_alt_alleles()),
-        ),
-        ac_release_samples_adj=hl.agg.filter(
-            mt.meta.release & mt.adj, hl.agg.sum(mt.GT.n_alt_alleles())
-        ),
+        )
+    )
+    ht = mt.rows()
+    ac_strata = ht._ac_strata.items()
+
+    def _sum_ac(strata_filter=lambda strata: True) -> hl.expr.Int64Expression:
+        return hl.sum(
+            ac_strata.filter(lambda x: strata_filter(x[0])).map(lambda x: x[1])
+        )
+
+    # Keep the split annotations, they are used downstream by `create_rf_ht`
+    return ht.select(
+        "a_index",
+        "was_split",
+        ac_qc_samples_raw=_sum_ac(),
+        ac_qc_samples_unrelated_raw=_sum_ac(lambda x: x.unrelated),
+        ac_release_samples_raw=_sum_ac(lambda x: x.release),
+        ac_qc_samples_adj=_sum_ac(lambda x: x.adj),
+        ac_qc_samples_unrelated_adj=_sum_ac(lambda x: x.unrelated & x.adj),
+        ac_release_samples_adj=_sum_ac(lambda x: x.release & x.adj),
     )
-    return mt.rows()
 
 
 def generate_fam_stats(mt: hl.MatrixTable, fam_file: str) -> hl.Table:
@@ -247,10 +305,16 @@ def generate_fam_stats(mt: hl.MatrixTable, fam_file: str) -> hl.Table:
 
     mt = mt.filter_cols(hl.is_defined(fam_ht[mt.col_key]))
     logger.info(
-        f"Generating family stats using {mt.count_cols()} samples from {len(ped.trios)} trios."
+        f"Generating family stats using {fam_ht.count()} samples from {len(ped.trios)} trios."
     )
 
-    mt = filter_to_autosomes(mt)
+    mt = hl.filter_intervals(
+        mt,
+        [
+            hl.parse_locus_interval(f"chr{contig}", reference_genome="GRCh38")
+            for contig in range(1, 23)
+        ],
+    )
     mt = annotate_adj(mt)
     mt = mt.select_entries("GT", "GQ", "AD", "END", "adj")
     mt = hl.experimental.densify(mt)
@@ -279,32 +343,48 @@ def export_transmitted_singletons_vcf():
     :return: None
     """
     qc_ac_ht = qc_ac.ht()
+    fam_stats_ht = fam_stats.ht()
 
-    for transmission_confidence in ["raw", "adj"]:
-        ts_ht = qc_ac_ht.filter(
-            (
-                fam_stats.ht()[qc_ac_ht.key][f"n_transmitted_{transmission_confidence}"]
+    # Join the family stats once and flag raw and adj transmitted singletons in the same pass
+    qc_ac_ht = qc_ac_ht.annotate(
+        **{
+            f"is_ts_{transmission_confidence}": (
+                fam_stats_ht[qc_ac_ht.key][f"n_transmitted_{transmission_confidence}"]
                 == 1
             )
             & (qc_ac_ht.ac_qc_samples_raw == 2)
-        )
+            for transmission_confidence in ["raw", "adj"]
+        }
+    )
+    qc_ac_ht = qc_ac_ht.filter(qc_ac_ht.is_ts_raw | qc_ac_ht.is_ts_adj)
+    qc_ac_ht = qc_ac_ht.checkpoint(
+        "gs://gnomad-tmp/transmitted_singletons.ht", overwrite=True
+    )
 
+    for transmission_confidence in ["raw", "adj"]:
+        ts_ht = qc_ac_ht.filter(qc_ac_ht[f"is_ts_{transmission_confidence}"])
+
+        ts_ht = ts_ht.drop("is_ts_raw", "is_ts_adj")
         ts_ht = ts_ht.annotate(s=hl.null(hl.tstr))
 
         ts_mt = ts_ht.to_matrix_table_row_major(columns=["s"], entry_field_name="s")
         ts_mt = ts_mt.filter_cols(False)
         hl.export_vcf(
             ts_mt,
-            get_transmitted_singleton_vcf_path(transmission_confidence),
+            get_transmitted_singleton_vcf_path(transmission_confidence == "adj"),
             tabix=True,
         )
 
 
-def run_vep(vep_version: str = "101") -> hl.Table:
+def run_vep(vep_version: str = "101", n_partitions: int = 5000) -> hl.Table:
     """
     Returns a table with a VEP annotation for each variant in the raw MatrixTable.
 
+    The split variants are coalesced into `n_partitions` partitions before running VEP so that each VEP process
+    is given a larger chunk of contiguous variants and its start-up cost is amortized.
+
     :param vep_version: Version of VEPed context Table to use in `vep_or_lookup_vep`
+    :param n_partitions: Number of partitions to coalesce the variants into before running VEP
     :return: VEPed Table
     """
     ht = get_gnomad_v3_mt(
@@ -312,6 +392,7 @@ def run_vep(vep_version: str = "101") -> hl.Table:
     ).rows()
     ht = ht.filter(hl.len(ht.alleles) > 1)
     ht = hl.split_multi_hts(ht)
+    ht = ht.naive_coalesce(n_partitions)
     ht = vep_or_lookup_vep(ht, vep_version=vep_version)
     ht = ht.annotate_globals(version=f"v{vep_version}")
 
@@ -337,34 +418,42 @@ def main(args):
             allele_data.path, overwrite=args.overwrite
         )
 
-    if args.generate_ac:  # TODO: compute AC and qc_AC as part of compute_info
+    if args.generate_ac or args.generate_fam_stats:
         mt = get_gnomad_v3_mt(key_by_locus_and_alleles=True, samples_meta=True)
         mt = hl.experimental.sparse_split_multi(mt, filter_changed_loci=True)
 
+        # Share a single read and split of the sparse MT when computing both ACs and family stats
+        if args.generate_ac and args.generate_fam_stats:
+            mt = mt.checkpoint(
+                "gs://gnomad-tmp/gnomad_v3_sparse_split.mt",
+                overwrite=args.overwrite,
+                _read_if_exists=not args.overwrite,
+            )
+
+    if args.generate_ac:
         ht = generate_ac(mt).checkpoint(
             "gs://gnomad-tmp/ac_tmp.ht",
             overwrite=args.overwrite,
             _read_if_exists=not args.overwrite,
         )
-        ht.repartition(10000, shuffle=False).write(qc_ac.path, overwrite=args.overwrite)
+        ht.naive_coalesce(10000).write(qc_ac.path, overwrite=args.overwrite)
 
     if args.generate_fam_stats:
-        mt = get_gnomad_v3_mt(key_by_locus_and_alleles=True, samples_meta=True)
-        mt = hl.experimental.sparse_split_multi(mt, filter_changed_loci=True)
         fam_stats_ht = generate_fam_stats(mt, trios.path)
         fam_stats_ht = fam_stats_ht.checkpoint(
             "gs://gnomad-tmp/fam_stats_tmp.ht",
             overwrite=args.overwrite,
             _read_if_exists=not args.overwrite,
         )
-        fam_stats_ht = fam_stats_ht.repartition(10000, shuffle=False)
+        fam_stats_ht = fam_stats_ht.naive_coalesce(10000)
         fam_stats_ht.write(fam_stats.path, overwrite=args.overwrite)
 
     if args.export_transmitted_singletons_vcf:
         export_transmitted_singletons_vcf()
 
     if args.vep:
-        run_vep(vep_version=args.vep_version).write(vep.path, overwrite=args.overwrite)
+        ht = run_vep(vep_version=args.vep_version, n_partitions=args.vep_n_partitions)
+        ht.write(vep.path, overwrite=args.overwrite)
 
 
 if __name__ == "__main__":
@@ -379,7 +468,7 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--generate_ac",
-        help="Creates a table with ACs for QC, unrelated QC and release samples (raw and adj)",
+        help="Creates a table with ACs for QC, unrelated QC and release samples (raw and adj). Requires sample QC metadata",
         action="store_true",
     )
     parser.add_argument(
@@ -394,6 +483,12 @@ if __name__ == "__main__":
         action="store_true",
         default="101",
     )
+    parser.add_argument(
+        "--vep_n_partitions",
+        help="Number of partitions to coalesce the variants into before running VEP",
+        type=int,
+        default=5000,
+    )
     parser.add_argument(
         "--export_transmitted_singletons_vcf",
         help="Exports transmitted singletons to VCF files.",
@@ -4,7 +4,7 @@ import logging
 
 import hail as hl
 from gnomad.resources.resource_utils import DataException
-from gnomad.utils.annotations import create_frequency_bins_expr, get_annotations_hists
+from gnomad.utils.annotations import create_frequency_bins_expr
 from gnomad.utils.file_utils import file_exists
 from gnomad.utils.slack import slack_notifications
 
@@ -29,29 +29,30 @@ LOG10_ANNOTATIONS = ["AS_VarDP", "QUALapprox", "AS_QUALapprox"]
 List of annotations to log scale when creating histograms. 
 """
 
+INBREEDING_AF_BINS = {"under_0.0005": True, "over_0.0005": False}
+"""
+Dictionary mapping the InbreedingCoeff allele frequency bin names to the value returned by
+`create_frequency_bins_expr_inbreeding` for that bin.
+"""
+
 
 def create_frequency_bins_expr_inbreeding(
     AF: hl.expr.NumericExpression,
-) -> hl.expr.StringExpression:
+) -> hl.expr.BooleanExpression:
     """
     Creates bins for frequencies in preparation for aggregating QUAL by frequency bin.
 
-    Uses bins of < 0.0005 and >= 0.0005
+    Uses bins of < 0.0005 and >= 0.0005. The bin is returned as a boolean rather than a bin name so that
+    grouping on it doesn't require a string per row; use `INBREEDING_AF_BINS` to get the boolean for a bin name.
 
     NOTE: Frequencies should be frequencies from raw data.
     Used when creating site quality distribution json files.
 
     :param AF: Field in input that contains the allele frequency information
-    :return: Expression containing bin name
-    :rtype: hl.expr.StringExpression
+    :return: Expression that is True for the < 0.0005 bin and False for the >= 0.0005 bin
+    :rtype: hl.expr.BooleanExpression
     """
-    bin_expr = (
-        hl.case()
-        .when(AF < 0.0005, "under_0.0005")
-        .when(AF >= 0.0005, "over_0.0005")
-        .or_missing()
-    )
-    return bin_expr
+    return AF < 0.0005
 
 
 def main(args):
@@ -70,14 +71,19 @@ def main(args):
     ht = hl.read_table(release_ht_path(public=False))
     ht = ht.select(freq=ht.freq, info=ht.info.select(*ANNOTATIONS_HISTS))
 
-    inbreeding_bin_ranges = ANNOTATIONS_HISTS["InbreedingCoeff"]
+    # Annotate the frequency bins and the log10 values of LOG10_ANNOTATIONS once so they are not recomputed inside
+    # each aggregator
+    ht = ht.annotate(
+        _freq_bin=create_frequency_bins_expr(AC=ht.freq[1].AC, AF=ht.freq[1].AF),
+        **{
+            f"_log10_{metric}": hl.log10(ht.info[metric])
+            for metric in LOG10_ANNOTATIONS
+        },
+    )
 
     # Remove InbreedingCoeff from ANNOTATIONS_HISTS. It requires different ranges by allele frequency and needs to be
     # handled differently. It is stored as a dictionary in annotation_hists_path
-    ANNOTATIONS_HISTS.remove("InbreedingCoeff")
-
-    logger.info("Getting info annotation histograms...")
-    hist_ranges_expr = get_annotations_hists(ht, ANNOTATIONS_HISTS, LOG10_ANNOTATIONS)
+    inbreeding_bin_ranges = ANNOTATIONS_HISTS.pop("InbreedingCoeff")
 
     # Evaluate minimum and maximum values for each metric of interest to help determine the bounds of the hists
     # NOTE: Run this first, then update values in annotation_hists_path JSON as necessary
@@ -87,13 +93,10 @@ def main(args):
         )
         minmax_dict = {}
         for metric in ANNOTATIONS_HISTS:
+            max_expr = hl.agg.max(ht.info[metric])
             minmax_dict[metric] = hl.struct(
                 min=hl.agg.min(ht.info[metric]),
-                max=hl.if_else(
-                    hl.agg.max(ht.info[metric]) < 1e10,
-                    hl.agg.max(ht.info[metric]),
-                    1e10,
-                ),
+                max=hl.if_else(max_expr < 1e10, max_expr, 1e10),
             )
         minmax = ht.aggregate(hl.struct(**minmax_dict))
         logger.info(f"Metrics bounds: {minmax}")
@@ -102,19 +105,28 @@ def main(args):
             "Aggregating hists over ranges defined in the annotation_hists_path JSON file. --determine_bounds can "
             "be used to help define these ranges..."
         )
-        hists = ht.aggregate(
-            hl.array(
-                [
-                    hist_expr.annotate(metric=hist_metric)
-                    for hist_metric, hist_expr in hist_ranges_expr.items()
-                ]
+        logger.info("Getting info annotation histograms...")
+        hist_ranges_expr = {
+            metric: hl.agg.hist(
+                ht[f"_log10_{metric}"]
+                if metric in LOG10_ANNOTATIONS
+                else ht.info[metric],
+                *hist_range,
             )
+            for metric, hist_range in ANNOTATIONS_HISTS.items()
+        }
+        hist_list = [
+            hist_expr.annotate(metric=hist_metric)
+            for hist_metric, hist_expr in hist_ranges_expr.items()
+        ]
+        hists = ht.aggregate(
+            hl.array(hist_list)
             .extend(
                 hl.array(
                     hl.agg.group_by(
-                        create_frequency_bins_expr(AC=ht.freq[1].AC, AF=ht.freq[1].AF),
+                        ht._freq_bin,
                         hl.agg.hist(
-                            hl.log10(ht.info.QUALapprox),
+                            ht._log10_QUALapprox,
                             *ANNOTATIONS_HISTS["QUALapprox"],
                         ),
                     )
@@ -123,15 +135,14 @@ def main(args):
             .extend(
                 hl.array(
                     hl.agg.group_by(
-                        create_frequency_bins_expr(AC=ht.freq[1].AC, AF=ht.freq[1].AF),
+                        ht._freq_bin,
                         hl.agg.hist(
-                            hl.log10(ht.info.AS_QUALapprox),
+                            ht._log10_AS_QUALapprox,
                             *ANNOTATIONS_HISTS["AS_QUALapprox"],
                         ),
                     )
                 ).map(lambda x: x[1].annotate(metric="AS_QUALapprox-" + x[0]))
             ),
-            _localize=False,
         )
 
         # Defining hist range and bins for allele frequency groups because they needed different ranges
@@ -139,23 +150,20 @@ def main(args):
         inbreeding_hists = [
             ht.aggregate(
                 hl.agg.filter(
-                    ht.af_bin == x,
+                    ht.af_bin == INBREEDING_AF_BINS[x],
                     hl.agg.hist(ht.info.InbreedingCoeff, *inbreeding_bin_ranges[x],),
                 )
             ).annotate(metric="InbreedingCoeff" + "-" + x)
             for x in inbreeding_bin_ranges
         ]
 
-        hists = hl.eval(hl.json(hists))
-        inbreeding_hists = hl.eval(hl.json(inbreeding_hists))
-
-        # Note: The following removes '}' from the JSON stored in hists and '{' from the JSON stored in
-        # inbreeding_hists then joins them together to be written out as a single JSON
-        hists = hists[:-1] + "," + inbreeding_hists[1:]
+        # Note: Both hists and inbreeding_hists are already local lists of structs, so they are joined together
+        # and serialized on the driver to be written out as a single JSON
+        hists = [dict(hist) for hist in hists + inbreeding_hists]
 
         logger.info("Writing output")
         with hl.hadoop_open(qual_hists_json_path(), "w") as f:
-            f.write(hists)
+            json.dump(hists, f)
 
 
 if __name__ == "__main__":
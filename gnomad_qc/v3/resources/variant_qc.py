@@ -168,6 +168,20 @@ def get_rf_annotations(adj: bool = False) -> VersionedTableResource:
     )
 
 
+rf_annotation_sidecar = VersionedTableResource(
+    CURRENT_RELEASE,
+    {
+        release: TableResource(
+            f"{get_variant_qc_root(release)}/rf/rf_annotation_sidecar.ht"
+        )
+        for release in RELEASES
+    },
+)
+"""
+Table merging the trio stats, truth data, allele data and QC allele counts used by `create_rf_ht`
+"""
+
+
 def rf_run_path(release: str = CURRENT_RELEASE):
     """
     Returns the path to the json file containing the RF runs list.
@@ -13,7 +13,7 @@ from gnomad.resources.grch38.reference_data import (
     purcell_5k_intervals,
     telomeres_and_centromeres,
 )
-from gnomad.sample_qc.ancestry import assign_population_pcs, run_pca_with_relateds
+from gnomad.sample_qc.ancestry import assign_population_pcs, pc_project
 from gnomad.sample_qc.filtering import (
     compute_qc_metrics_residuals,
     compute_stratified_metrics_filter,
@@ -32,7 +32,6 @@ from gnomad.sample_qc.sex import get_ploidy_cutoffs, get_sex_expr
 from gnomad.utils.annotations import bi_allelic_expr, get_adj_expr
 from gnomad.utils.filtering import (
     add_filters_expr,
-    filter_low_conf_regions,
     filter_to_autosomes,
     filter_to_clinvar_pathogenic,
 )
@@ -84,6 +83,26 @@ SUBSETS = [
 Default list of subsets to include in the sample QC meta HT from the project meta HT
 """
 
+HARD_FILTER_NAMES = [
+    "failed_fingerprinting",
+    "TCGA_tumor_sample",
+    "low_coverage",
+    "bad_qc_metrics",
+    "contamination",
+    "chimera",
+    "insert_size",
+    "ambiguous_sex",
+    "sex_aneuploidy",
+]
+"""
+Names of all hard filters that can be applied by `compute_hard_filters`
+"""
+
+SAMPLE_HT_N_PARTITIONS = 10
+"""
+Number of partitions to coalesce sample-level Tables (one row per sample) to before writing them
+"""
+
 
 def compute_sample_qc() -> hl.Table:
     """
@@ -100,31 +119,26 @@ def compute_sample_qc() -> hl.Table:
             remove_hard_filtered_samples=False,
         )
     )
+
+    # Remove centromeres and telomeres incase they were included
+    # NOTE: The gnomAD v3.1 sample QC metrics were computed without this filter, so metrics computed here differ
+    mt = hl.filter_intervals(
+        mt, telomeres_and_centromeres.ht().interval.collect(), keep=False
+    )
     mt = mt.select_entries("GT")
 
     # Filter reference blocks
     mt = filter_ref_blocks(mt)
 
-    # Remove centromeres and telomeres incase they were included
-    filter_low_conf_regions(
-        mt,
-        filter_lcr=False,
-        filter_decoy=False,
-        filter_segdup=False,
-        filter_telomeres_and_centromeres=True,
-    )
-
+    bi_allelic = bi_allelic_expr(mt)
     sample_qc_ht = compute_stratified_sample_qc(
         mt,
-        strata={
-            "bi_allelic": bi_allelic_expr(mt),
-            "multi_allelic": ~bi_allelic_expr(mt),
-        },
+        strata={"bi_allelic": bi_allelic, "multi_allelic": ~bi_allelic},
         tmp_ht_prefix=get_sample_qc().path[:-3],
     )
 
     # Remove annotations that cannot be computed from the sparse format
-    sample_qc_ht = sample_qc_ht.annotate(
+    sample_qc_ht = sample_qc_ht.select(
         **{
             x: sample_qc_ht[x].drop(
                 "n_called", "n_not_called", "n_filtered", "call_rate"
@@ -150,11 +164,18 @@ def compute_qc_mt(
     """
     # Load v2 and p5k sites for QC
     v2_qc_sites = get_liftover_v2_qc_mt("joint", ld_pruned=True).rows().key_by("locus")
-    qc_sites = v2_qc_sites.union(purcell_5k_intervals.ht(), unify=True)
+    # The p5k sites are small, so localize them to avoid a distributed union of two Tables
+    p5k_ht = purcell_5k_intervals.ht()
+    p5k_ht = hl.Table.parallelize(
+        p5k_ht.collect(), schema=p5k_ht.row.dtype, key=list(p5k_ht.key)
+    )
+    qc_sites = v2_qc_sites.union(p5k_ht, unify=True)
 
     qc_sites = qc_sites.filter(hl.is_missing(lcr_intervals.ht()[qc_sites.key]))
 
     mt = get_gnomad_v3_mt(key_by_locus_and_alleles=True)
+    # Only read the entry fields needed for the genotype and adj annotations
+    mt = mt.select_entries("LGT", "GQ", "DP", "LAD", "END")
     mt = mt.select_entries(
         "END", GT=mt.LGT, adj=get_adj_expr(mt.LGT, mt.GQ, mt.DP, mt.LAD)
     )
@@ -166,9 +187,6 @@ def compute_qc_mt(
         & hl.is_snp(mt.alleles[0], mt.alleles[1])
         & (qc_sites[mt.locus].alleles == mt.alleles)
     )
-    mt = mt.checkpoint(
-        "gs://gnomad-tmp/gnomad_v3_qc_mt_v2_sites_dense.mt", overwrite=True
-    )
     mt = mt.naive_coalesce(5000)
     mt = mt.checkpoint(
         "gs://gnomad-tmp/gnomad_v3_qc_mt_v2_sites_dense_repartitioned.mt",
@@ -195,6 +213,41 @@ def compute_qc_mt(
     return qc_mt
 
 
+def get_sample_cols_ht(overwrite: bool = False) -> hl.Table:
+    """
+    Get the sample Table of the raw gnomAD v3 MT, including hard filtered samples.
+
+    The Table is checkpointed to the temp bucket and read back on later calls, avoiding opening the full MatrixTable
+    just for its columns.
+
+    :param overwrite: Whether to overwrite the checkpointed sample Table
+    :return: Table of all samples in the raw gnomAD v3 MT
+    :rtype: hl.Table
+    """
+    return (
+        get_gnomad_v3_mt(remove_hard_filtered_samples=False)
+        .cols()
+        .checkpoint(
+            "gs://gnomad-tmp/gnomad_v3_samples.ht",
+            overwrite=overwrite,
+            _read_if_exists=not overwrite,
+        )
+    )
+
+
+def get_sample_dict_expr(ht: hl.Table) -> hl.expr.DictExpression:
+    """
+    Collect a small Table keyed by sample into a dict of sample ID to row value.
+
+    Lookups in the returned dict are done map-side, avoiding a join against the Table.
+
+    :param Table ht: Table keyed by sample (s)
+    :return: Dict expression mapping each sample ID to its row value
+    :rtype: hl.expr.DictExpression
+    """
+    return hl.dict(ht.aggregate(hl.agg.collect((ht.s, ht.row_value)), _localize=False))
+
+
 def compute_hard_filters(
     cov_threshold: int = 15,
     max_n_snp: float = 3.75e6,
@@ -205,6 +258,7 @@ def compute_hard_filters(
     max_pct_chimera: float = 5.00,
     min_median_insert_size: int = 250,
     include_sex_filter: bool = True,
+    overwrite: bool = False,
 ) -> hl.Table:
     """
     Apply hard filters to samples and return Table with samples and the reason for filtering. 
@@ -222,10 +276,13 @@ def compute_hard_filters(
         e.g. 5% == 5.00, %5 != 0.05)
     :param min_median_insert_size: Filtering threshold to use for min median insert size
     :param include_sex_filter: Should sex inference be used in filtering
+    :param overwrite: Whether to overwrite the checkpointed sample Table used as the base of the hard filters
     :return: Table of hard filtered samples
     :rtype: hl.Table
     """
-    ht = get_gnomad_v3_mt(remove_hard_filtered_samples=False).cols()
+    ht = get_sample_cols_ht(overwrite)
+    sex_ht = sex.ht().select("chr20_mean_dp", "sex_karyotype")
+    sex_expr = get_sample_dict_expr(sex_ht).get(ht.s)
     hard_filters = dict()
 
     # Remove samples failing fingerprinting
@@ -241,35 +298,41 @@ def compute_hard_filters(
 
     # Remove low-coverage samples
     # chrom 20 coverage is computed to infer sex and used here
-    cov_ht = sex.ht()
-    hard_filters["low_coverage"] = cov_ht[ht.key].chr20_mean_dp < cov_threshold
+    hard_filters["low_coverage"] = sex_expr.chr20_mean_dp < cov_threshold
 
     # Remove extreme raw bi-allelic sample QC outliers
     # These were determined by visual inspection of the metrics
-    bi_allelic_qc_struct = get_sample_qc("bi_allelic").ht()[ht.key]
+    bi_allelic_qc_ht = get_sample_qc("bi_allelic").ht()
+    bi_allelic_qc_ht = bi_allelic_qc_ht.select(
+        **bi_allelic_qc_ht.sample_qc.select("n_snp", "n_singleton", "r_het_hom_var")
+    )
+    bi_allelic_qc = get_sample_dict_expr(bi_allelic_qc_ht).get(ht.s)
     hard_filters["bad_qc_metrics"] = (
-        (bi_allelic_qc_struct.sample_qc.n_snp > max_n_snp)
-        | (bi_allelic_qc_struct.sample_qc.n_snp < min_n_snp)
-        | (bi_allelic_qc_struct.sample_qc.n_singleton > max_n_singleton)
-        | (bi_allelic_qc_struct.sample_qc.r_het_hom_var > max_r_het_hom_var)
+        (bi_allelic_qc.n_snp > max_n_snp)
+        | (bi_allelic_qc.n_snp < min_n_snp)
+        | (bi_allelic_qc.n_singleton > max_n_singleton)
+        | (bi_allelic_qc.r_het_hom_var > max_r_het_hom_var)
     )
 
     # Remove samples that fail picard metric thresholds
-    picard_ht = picard_metrics.ht()[ht.key]
-    hard_filters["contamination"] = (
-        picard_ht.bam_metrics.freemix > max_pct_contamination
+    picard_ht = picard_metrics.ht()
+    picard_ht = picard_ht.select(
+        **picard_ht.bam_metrics.select("freemix", "pct_chimeras", "median_insert_size")
     )
-    hard_filters["chimera"] = picard_ht.bam_metrics.pct_chimeras > max_pct_chimera
+    bam_metrics = get_sample_dict_expr(picard_ht).get(ht.s)
+    hard_filters["contamination"] = bam_metrics.freemix > max_pct_contamination
+    hard_filters["chimera"] = bam_metrics.pct_chimeras > max_pct_chimera
     hard_filters["insert_size"] = (
-        picard_ht.bam_metrics.median_insert_size < min_median_insert_size
+        bam_metrics.median_insert_size < min_median_insert_size
     )
 
     if include_sex_filter:
         # Remove samples with ambiguous sex assignments
-        sex_ht = sex.ht()[ht.key]
-        hard_filters["ambiguous_sex"] = sex_ht.sex_karyotype == "ambiguous"
-        hard_filters["sex_aneuploidy"] = ~hl.set({"ambiguous", "XX", "XY"}).contains(  # pylint: disable=invalid-unary-operand-type
-            sex_ht.sex_karyotype
+        hard_filters["ambiguous_sex"] = sex_expr.sex_karyotype == "ambiguous"
+        hard_filters["sex_aneuploidy"] = (
+            (sex_expr.sex_karyotype != "ambiguous")
+            & (sex_expr.sex_karyotype != "XX")
+            & (sex_expr.sex_karyotype != "XY")
         )
 
     ht = ht.annotate(hard_filters=add_filters_expr(filters=hard_filters))
@@ -349,29 +412,27 @@ def reannotate_sex(
     new_x_ploidy_cutoffs, new_y_ploidy_cutoffs = get_ploidy_cutoffs(
         sex_ht.filter(hl.is_missing(hard_filter_ht[sex_ht.key])), f_stat_cutoff=0.5
     )
-    x_ploidy_cutoffs = hl.struct(
-        upper_x=x_ploidy_cutoffs[0] if x_ploidy_cutoffs[0] else new_x_ploidy_cutoffs[0],
-        lower_xx=x_ploidy_cutoffs[1][0]
-        if x_ploidy_cutoffs[1][0]
-        else new_x_ploidy_cutoffs[1][0],
-        upper_xx=x_ploidy_cutoffs[1][1]
-        if x_ploidy_cutoffs[1][1]
-        else new_x_ploidy_cutoffs[1][1],
-        lower_xxx=x_ploidy_cutoffs[2]
-        if x_ploidy_cutoffs[2]
-        else new_x_ploidy_cutoffs[2],
-    )
-    y_ploidy_cutoffs = hl.struct(
-        lower_y=y_ploidy_cutoffs[0][0]
-        if y_ploidy_cutoffs[0][0]
-        else new_y_ploidy_cutoffs[0][0],
-        upper_y=y_ploidy_cutoffs[0][1]
-        if y_ploidy_cutoffs[0][1]
-        else new_y_ploidy_cutoffs[0][1],
-        lower_yy=y_ploidy_cutoffs[1]
-        if y_ploidy_cutoffs[1]
-        else new_y_ploidy_cutoffs[1],
-    )
+    # Use the provided cutoffs where set, otherwise the cutoffs inferred from the sex HT
+    x_ploidy_cutoffs = {
+        name: cutoff or new_cutoff
+        for name, cutoff, new_cutoff in zip(
+            ["upper_x", "lower_xx", "upper_xx", "lower_xxx"],
+            [x_ploidy_cutoffs[0], *x_ploidy_cutoffs[1], x_ploidy_cutoffs[2]],
+            [
+                new_x_ploidy_cutoffs[0],
+                *new_x_ploidy_cutoffs[1],
+                new_x_ploidy_cutoffs[2],
+            ],
+        )
+    }
+    y_ploidy_cutoffs = {
+        name: cutoff or new_cutoff
+        for name, cutoff, new_cutoff in zip(
+            ["lower_y", "upper_y", "lower_yy"],
+            [*y_ploidy_cutoffs[0], y_ploidy_cutoffs[1]],
+            [*new_y_ploidy_cutoffs[0], new_y_ploidy_cutoffs[1]],
+        )
+    }
     sex_ht = sex_ht.annotate(
         **get_sex_expr(
             sex_ht.chrX_ploidy,
@@ -388,7 +449,8 @@ def reannotate_sex(
         )
     )
     sex_ht = sex_ht.annotate_globals(
-        x_ploidy_cutoffs=x_ploidy_cutoffs, y_ploidy_cutoffs=y_ploidy_cutoffs,
+        x_ploidy_cutoffs=hl.struct(**x_ploidy_cutoffs),
+        y_ploidy_cutoffs=hl.struct(**y_ploidy_cutoffs),
     )
 
     return sex_ht
@@ -406,50 +468,58 @@ def compute_sample_rankings(use_qc_metrics_filters: bool) -> hl.Table:
     :rtype: hl.Table
     """
     project_ht = project_meta.ht()
-    project_ht = project_ht.select(
-        "releasable",
-        "exclude",
-        chr20_mean_dp=sex.ht()[project_ht.key].chr20_mean_dp,
-        filtered=hl.or_else(
-            hl.len(hard_filtered_samples.ht()[project_ht.key].hard_filters) > 0, False
-        ),
+    sex_ht = sex.ht()
+    hard_filtered_ht = hard_filtered_samples.ht()
+    filtered_expr = hl.or_else(
+        hl.len(hard_filtered_ht[project_ht.key].hard_filters) > 0, False
     )
-
     if use_qc_metrics_filters:
-        project_ht = project_ht.annotate(
-            filtered=hl.cond(
-                project_ht.filtered,
-                True,
-                hl.or_else(
-                    hl.len(regressed_metrics.ht()[project_ht.key].qc_metrics_filters)
-                    > 0,
-                    False,
-                ),
-            )
+        regressed_metrics_ht = regressed_metrics.ht()
+        filtered_expr = filtered_expr | hl.or_else(
+            hl.len(regressed_metrics_ht[project_ht.key].qc_metrics_filters) > 0, False
         )
 
+    project_ht = project_ht.select(
+        chr20_mean_dp=sex_ht[project_ht.key].chr20_mean_dp,
+        filtered=filtered_expr,
+        _release=project_ht.releasable & ~project_ht.exclude,
+    )
+
     project_ht = project_ht.order_by(
         project_ht.filtered,
-        hl.desc(project_ht.releasable & ~project_ht.exclude),
+        hl.desc(project_ht._release),
         hl.desc(project_ht.chr20_mean_dp),
     ).add_index(name="rank")
 
     return project_ht.key_by("s").select("filtered", "rank")
 
 
+# NOTE: This is a copy of gnomad's `run_pca_with_relateds` (autosome filter, dropping related samples, pca_af
+# annotation of the loadings and projection of the dropped samples with `pc_project`) wrapped around Hail's private
+# `hl._hwe_normalized_blanczos` instead of `hl.hwe_normalized_pca`. Keep it in sync with `run_pca_with_relateds`.
+# `_hwe_normalized_blanczos` is not a public API; requirements.txt pins the Hail versions it was checked against.
 def run_pca(
-    include_unreleasable_samples: bool, n_pcs: int, related_samples_to_drop: hl.Table
+    include_unreleasable_samples: bool,
+    n_pcs: int,
+    related_samples_to_drop: hl.Table,
+    q_iterations: int = 10,
+    oversampling_param: int = 10,
 ) -> Tuple[List[float], hl.Table, hl.Table]:
     """
-    Run population PCA using `run_pca_with_relateds`.
+    Run population PCA on unrelated samples and project the dropped samples into the PC space.
+
+    This follows `run_pca_with_relateds`, but uses Hail's randomized block Lanczos PCA, which needs far fewer passes
+    over the QC MT than `hwe_normalized_pca` for the number of PCs used here.
 
     :param include_unreleasable_samples: Should unreleasable samples be included in the PCA
     :param n_pcs: Number of PCs to compute
     :param related_samples_to_drop: Table of related samples to drop from PCA run
+    :param q_iterations: Number of power iterations for the randomized PCA
+    :param oversampling_param: Number of extra dimensions used by the randomized PCA to improve accuracy
     :return: eigenvalues, scores and loadings
     """
     logger.info("Running population PCA")
-    qc_mt = qc.mt()
+    qc_mt = filter_to_autosomes(qc.mt())
 
     samples_to_drop = related_samples_to_drop.select()
     if not include_unreleasable_samples:
@@ -465,7 +535,25 @@ def run_pca(
     else:
         logger.info("Including unreleasable samples for PCA")
 
-    return run_pca_with_relateds(qc_mt, samples_to_drop, n_pcs=n_pcs)
+    pca_mt = qc_mt.filter_cols(hl.is_missing(samples_to_drop[qc_mt.col_key]))
+    pca_evals, pca_scores, pca_loadings = hl._hwe_normalized_blanczos(
+        pca_mt.GT,
+        k=n_pcs,
+        compute_loadings=True,
+        q_iterations=q_iterations,
+        oversampling_param=oversampling_param,
+    )
+    pca_af_ht = pca_mt.annotate_rows(
+        pca_af=hl.agg.mean(pca_mt.GT.n_alt_alleles()) / 2
+    ).rows()
+    pca_loadings = pca_loadings.annotate(pca_af=pca_af_ht[pca_loadings.key].pca_af)
+    pca_loadings = pca_loadings.persist()
+    pca_scores = pca_scores.persist()
+
+    project_pca_mt = qc_mt.filter_cols(hl.is_defined(samples_to_drop[qc_mt.col_key]))
+    projected_scores = pc_project(project_pca_mt, pca_loadings)
+
+    return pca_evals, pca_scores.union(projected_scores), pca_loadings
 
 
 def assign_pops(
@@ -517,6 +605,9 @@ def assign_pops(
                 pop_pca_scores_ht.training_pop,
             )
         )
+    pop_pca_scores_ht = pop_pca_scores_ht.checkpoint(
+        "gs://gnomad-tmp/pop_pca_init.ht", overwrite=True
+    )
 
     logger.info(
         "Running RF using {} training examples".format(
@@ -528,7 +619,7 @@ def assign_pops(
 
     pop_ht, pops_rf_model = assign_population_pcs(
         pop_pca_scores_ht,
-        pc_cols=pop_pca_scores_ht.scores[:n_pcs],
+        pc_cols=[pop_pca_scores_ht.scores[i] for i in range(n_pcs)],
         known_col="training_pop",
         min_prob=min_prob,
     )
@@ -556,7 +647,9 @@ def assign_pops(
                 | (pop_ht.training_pop == pop_ht.pop),
                 pop_pca_scores_ht.training_pop_all,
             ),
-        ).persist()
+        ).checkpoint(
+            f"gs://gnomad-tmp/pop_iter_{pop_assignment_iter}.ht", overwrite=True
+        )
 
         logger.info(
             "Running RF using {} training examples".format(
@@ -568,7 +661,7 @@ def assign_pops(
 
         pop_ht, pops_rf_model = assign_population_pcs(
             pop_pca_scores_ht,
-            pc_cols=pop_pca_scores_ht.scores[:n_pcs],
+            pc_cols=[pop_pca_scores_ht.scores[i] for i in range(n_pcs)],
             known_col="training_pop",
             min_prob=min_prob,
         )
@@ -710,6 +803,18 @@ def get_relatedness_set_ht(relatedness_ht: hl.Table) -> hl.Table:
     return relatedness_ht
 
 
+def key_relatedness_by_sample_ids(relatedness_ht: hl.Table) -> hl.Table:
+    """
+    Key the pc_relate output Table by the sample IDs of each pair rather than by the sample key structs.
+
+    :param Table relatedness_ht: Table with inferred relationship information output by pc_relate.
+        Keyed by sample pair (i, j).
+    :return: Table keyed by sample IDs (i, j)
+    :rtype: hl.Table
+    """
+    return relatedness_ht.key_by(i=relatedness_ht.i.s, j=relatedness_ht.j.s)
+
+
 def get_relationship_filter_expr(
     hard_filtered_expr: hl.expr.BooleanExpression,
     relationship: str,
@@ -732,6 +837,43 @@ def get_relationship_filter_expr(
     )
 
 
+def get_filtered_samples_expr(
+    rank_ht: hl.Table, localize: bool = False
+) -> hl.expr.SetExpression:
+    """
+    Get the set of filtered samples in a sample rankings Table for use in `compute_related_samples_to_drop`.
+
+    By default the set is kept in the distributed plan rather than collected to the driver and broadcast as a literal.
+
+    :param rank_ht: Sample rankings Table output by `compute_sample_rankings`
+    :param localize: Whether to collect the set to the driver and return it as a literal
+    :return: Set of filtered sample IDs
+    :rtype: hl.expr.SetExpression
+    """
+    filtered_samples = rank_ht.aggregate(
+        hl.agg.filter(rank_ht.filtered, hl.agg.collect_as_set(rank_ht.s)),
+        _localize=localize,
+    )
+    if localize:
+        return hl.literal(filtered_samples)
+
+    return filtered_samples
+
+
+def get_pc_struct_expr(
+    pca_scores_expr: hl.expr.ArrayExpression, n_pcs: int
+) -> hl.expr.StructExpression:
+    """
+    Get a struct with one field per PC (PC1, PC2, ...) from an array of PCA scores for TSV export.
+
+    :param pca_scores_expr: Array of PCA scores
+    :param n_pcs: Number of PCs to include
+    :return: Struct of PC scores
+    :rtype: hl.expr.StructExpression
+    """
+    return hl.struct(**{f"PC{i + 1}": pca_scores_expr[i] for i in range(n_pcs)})
+
+
 def join_tables(
     left_ht: hl.Table,
     left_key: str,
@@ -739,11 +881,13 @@ def join_tables(
     right_key: str,
     join_type: str,
     sample_count_match: bool = True,
+    verbose: bool = False,
 ) -> hl.Table:
     """
     Joins left and right tables using specified keys and join types and returns result.
 
-    Also prints warning if sample counts are not the same.
+    If `verbose` is set, also prints warning if sample counts are not the same. This requires counting both tables,
+    so it is skipped by default.
 
     :param Table left_ht: Left Table to be joined
     :param str left_key: Key of left Table
@@ -751,25 +895,27 @@ def join_tables(
     :param str right_key: Key of right Table
     :param str join_type: Type of join
     :param bool sample_count_match: Are the sample counts expected to match in the tables
+    :param bool verbose: Whether to check and report sample count mismatches between the tables
     :return: Table with annotations
     :rtype: Table
     """
-    if sample_count_match and not compare_row_counts(left_ht, right_ht):
+    if verbose and sample_count_match and not compare_row_counts(left_ht, right_ht):
         logger.warning("Sample counts in left and right tables do not match!")
 
+        # Collect the mismatched samples once instead of counting and then showing them
         in_left_not_right = left_ht.anti_join(right_ht)
-        if in_left_not_right.count() != 0:
+        in_left_not_right = in_left_not_right[left_key].collect()
+        if in_left_not_right:
             logger.warning(
-                f"The following {in_left_not_right.count()} samples are found in the left HT, but are not found in the right HT"
+                f"The following {len(in_left_not_right)} samples are found in the left HT, but are not found in the right HT: {in_left_not_right}"
             )
-            in_left_not_right.select().show(n=-1)
 
         in_right_not_left = right_ht.anti_join(left_ht)
-        if in_right_not_left.count() != 0:
+        in_right_not_left = in_right_not_left[right_key].collect()
+        if in_right_not_left:
             logger.warning(
-                f"The following {in_right_not_left.count()} samples are found in the right HT, but are not found in left HT"
+                f"The following {len(in_right_not_left)} samples are found in the right HT, but are not found in left HT: {in_right_not_left}"
             )
-            in_right_not_left.select().show(n=-1)
 
         if join_type != "outer":
             logger.warning(
@@ -779,11 +925,14 @@ def join_tables(
     return left_ht.key_by(left_key).join(right_ht.key_by(right_key), how=join_type)
 
 
-def generate_metadata(regressed_metrics_outlier: bool = True) -> hl.Table:
+def generate_metadata(
+    regressed_metrics_outlier: bool = True, verbose: bool = False
+) -> hl.Table:
     """
     Pull all sample QC information together in one Table.
 
     :param regressed_metrics_outlier: Should the outlier table be from the residuals instead of pop stratified
+    :param verbose: Whether to report sample count mismatches for each join and describe the final Table
     :return: Table annotated with all metadata
     :rtype: hl.Table
     """
@@ -792,41 +941,49 @@ def generate_metadata(regressed_metrics_outlier: bool = True) -> hl.Table:
     logger.info(
         "Loading metadata file with subset, age, and releasable information to begin creation of the meta HT"
     )
-    left_ht = get_gnomad_v3_mt(remove_hard_filtered_samples=False).cols()
-
-    right_ht = project_meta.ht()
-    right_ht = right_ht.select(
-        project_meta=hl.struct(**right_ht.row.drop(*(SUBSETS + ["s"]))),
-        subsets=hl.struct(**{x: right_ht[x] for x in SUBSETS}),
+    project_meta_ht = project_meta.ht()
+    project_meta_fields = [x for x in project_meta_ht.row_value if x not in SUBSETS]
+    project_meta_ht = project_meta_ht.select(
+        project_meta=project_meta_ht.row_value.select(*project_meta_fields),
+        subsets=project_meta_ht.row_value.select(*SUBSETS),
     )
-    left_ht = join_tables(left_ht, "s", right_ht.select_globals(), "s", "right")
 
-    logger.info(logging_statement.format("picard metric HT"))
-    right_ht = picard_metrics.ht()
-    right_ht = right_ht.select("bam_metrics")
-    left_ht = join_tables(left_ht, "s", right_ht, "s", "left", sample_count_match=False)
+    logger.info("Reading in picard metric HT")
+    picard_ht = picard_metrics.ht()
+    picard_ht = picard_ht.select("bam_metrics")
 
-    logger.info(logging_statement.format("sex HT"))
+    logger.info("Reading in sex HT")
     impute_stats = ["f_stat", "n_called", "expected_homs", "observed_homs"]
-    right_ht = sex.ht()
-    right_ht = right_ht.transmute(
-        impute_sex_stats=hl.struct(**{x: right_ht[x] for x in impute_stats})
+    sex_ht = sex.ht()
+    sex_ht = sex_ht.transmute(
+        impute_sex_stats=hl.struct(**{x: sex_ht[x] for x in impute_stats})
     )
+    sex_ht = sex_ht.select(sex_imputation=hl.struct(**sex_ht.row.drop("s")))
+    sex_ht = sex_ht.select_globals(sex_imputation_ploidy_cutoffs=sex_ht.globals)
 
-    # Create struct for join
-    right_ht = right_ht.select(sex_imputation=hl.struct(**right_ht.row.drop("s")))
-    right_ht = right_ht.select_globals(sex_imputation_ploidy_cutoffs=right_ht.globals)
-    left_ht = join_tables(left_ht, "s", right_ht, "s", "right")
-
-    logger.info(logging_statement.format("sample QC HT"))
-    right_ht = get_sample_qc("bi_allelic").ht()
+    logger.info("Reading in sample QC HT")
+    sample_qc_ht = get_sample_qc("bi_allelic").ht()
 
     # Remove annotations that cannot be computed from the sparse format
     not_in_sparse = ["n_called", "n_not_called", "n_filtered", "call_rate"]
-    right_ht = right_ht.annotate(
-        **{x: right_ht[x].drop(*not_in_sparse) for x in right_ht.row_value}
+    sample_qc_ht = sample_qc_ht.select(
+        **{x: sample_qc_ht[x].drop(*not_in_sparse) for x in sample_qc_ht.row_value}
+    )
+
+    # The meta HT contains the samples in the sample QC HT, so use it as the base and look up the project meta,
+    # picard metric, and sex HTs against it in a single select rather than joining each one
+    logger.info(
+        "Annotating sample QC HT with project meta, picard metric, and sex HT information"
+    )
+    left_ht = sample_qc_ht.select(
+        **project_meta_ht[sample_qc_ht.key],
+        **picard_ht[sample_qc_ht.key],
+        **sex_ht[sample_qc_ht.key],
+        **sample_qc_ht.row_value,
+    )
+    left_ht = left_ht.annotate_globals(
+        **picard_ht.index_globals(), **sex_ht.index_globals()
     )
-    left_ht = join_tables(left_ht, "s", right_ht, "s", "right")
 
     logger.info(logging_statement.format("population PCA HT"))
     right_ht = pop.ht()
@@ -835,7 +992,13 @@ def generate_metadata(regressed_metrics_outlier: bool = True) -> hl.Table:
     )
     right_ht = right_ht.select(population_inference=hl.struct(**right_ht.row.drop("s")))
     left_ht = join_tables(
-        left_ht, "s", right_ht, "s", "outer", sample_count_match=False
+        left_ht,
+        "s",
+        right_ht,
+        "s",
+        "outer",
+        sample_count_match=False,
+        verbose=verbose,
     )
 
     logger.info(
@@ -843,27 +1006,26 @@ def generate_metadata(regressed_metrics_outlier: bool = True) -> hl.Table:
     )
     right_ht = hard_filtered_samples.ht()
     left_ht = join_tables(
-        left_ht, "s", right_ht, "s", "outer", sample_count_match=False
+        left_ht,
+        "s",
+        right_ht,
+        "s",
+        "outer",
+        sample_count_match=False,
+        verbose=verbose,
     )
 
     # Change sample_filters to a struct
-    ex_right_ht = right_ht.explode(right_ht.hard_filters)
-    hard_filters = ex_right_ht.aggregate(
-        hl.agg.collect_as_set(ex_right_ht.hard_filters)
-    )
+    hard_filters = left_ht.hard_filters
+    has_hard_filters = hl.is_defined(hard_filters)
     left_ht = left_ht.transmute(
         sample_filters=hl.struct(
             **{
-                v: hl.if_else(
-                    hl.is_defined(left_ht.hard_filters),
-                    left_ht.hard_filters.contains(v),
-                    False,
-                )
-                for v in hard_filters
+                v: has_hard_filters & hard_filters.contains(v)
+                for v in HARD_FILTER_NAMES
             },
-            hard_filters=left_ht.hard_filters,
-            hard_filtered=hl.is_defined(left_ht.hard_filters)
-            & (hl.len(left_ht.hard_filters) > 0),
+            hard_filters=hard_filters,
+            hard_filtered=has_hard_filters & (hl.len(hard_filters) > 0),
         )
     )
 
@@ -885,39 +1047,36 @@ def generate_metadata(regressed_metrics_outlier: bool = True) -> hl.Table:
     # Any sample that was filtered for relatedness will have True for sample_filters.related
     # If a filtered related sample had a relationship with a higher degree than second-degree (duplicate, parent-child, sibling),
     # that filter will also be True
-    release_else_expr = release_related_samples_to_drop_ht[left_ht.key].relationships
-    all_else_expr = related_samples_to_drop_ht[left_ht.key].relationships
+    release_related = release_related_samples_to_drop_ht[left_ht.key]
+    all_related = related_samples_to_drop_ht[left_ht.key]
+    hard_filtered_expr = left_ht.sample_filters.hard_filtered
+    release_else_expr = release_related.relationships
+    all_else_expr = all_related.relationships
     left_ht = left_ht.annotate(
         sample_filters=left_ht.sample_filters.annotate(
             release_related=hl.if_else(
-                left_ht.sample_filters.hard_filtered,
-                hl.null(hl.tbool),
-                hl.is_defined(release_related_samples_to_drop_ht[left_ht.key]),
+                hard_filtered_expr, hl.null(hl.tbool), hl.is_defined(release_related)
             ),
             release_duplicate=get_relationship_filter_expr(
-                left_ht.sample_filters.hard_filtered,
-                DUPLICATE_OR_TWINS,
-                release_else_expr,
+                hard_filtered_expr, DUPLICATE_OR_TWINS, release_else_expr
             ),
             release_parent_child=get_relationship_filter_expr(
-                left_ht.sample_filters.hard_filtered, PARENT_CHILD, release_else_expr,
+                hard_filtered_expr, PARENT_CHILD, release_else_expr
             ),
             release_sibling=get_relationship_filter_expr(
-                left_ht.sample_filters.hard_filtered, SIBLINGS, release_else_expr,
+                hard_filtered_expr, SIBLINGS, release_else_expr
             ),
             all_samples_related=hl.if_else(
-                left_ht.sample_filters.hard_filtered,
-                hl.null(hl.tbool),
-                hl.is_defined(related_samples_to_drop_ht[left_ht.key]),
+                hard_filtered_expr, hl.null(hl.tbool), hl.is_defined(all_related)
             ),
             all_samples_duplicate=get_relationship_filter_expr(
-                left_ht.sample_filters.hard_filtered, DUPLICATE_OR_TWINS, all_else_expr,
+                hard_filtered_expr, DUPLICATE_OR_TWINS, all_else_expr
             ),
             all_samples_parent_child=get_relationship_filter_expr(
-                left_ht.sample_filters.hard_filtered, PARENT_CHILD, all_else_expr,
+                hard_filtered_expr, PARENT_CHILD, all_else_expr
             ),
             all_samples_sibling=get_relationship_filter_expr(
-                left_ht.sample_filters.hard_filtered, SIBLINGS, all_else_expr,
+                hard_filtered_expr, SIBLINGS, all_else_expr
             ),
         )
     )
@@ -944,17 +1103,20 @@ def generate_metadata(regressed_metrics_outlier: bool = True) -> hl.Table:
         )
     )
 
-    left_ht = join_tables(left_ht, "s", right_ht, "s", "outer")
+    fail_fields = [x for x in right_ht.row if x.startswith("fail_")]
+    residual_fields = [x for x in right_ht.row if x.endswith("_residual")]
+
+    left_ht = join_tables(left_ht, "s", right_ht, "s", "outer", verbose=verbose)
     left_ht = left_ht.transmute(
         sample_filters=left_ht.sample_filters.annotate(
-            **{x: left_ht[x] for x in left_ht.row if x.startswith("fail_")},
+            **{x: left_ht[x] for x in fail_fields},
             qc_metrics_filters=left_ht.qc_metrics_filters,
         )
     )
     if regressed_metrics_outlier:
         left_ht = left_ht.transmute(
             sample_qc=left_ht.sample_qc.annotate(
-                **{x: left_ht[x] for x in left_ht.row if x.endswith("_residual")},
+                **{x: left_ht[x] for x in residual_fields},
             )
         )
 
@@ -972,13 +1134,13 @@ def generate_metadata(regressed_metrics_outlier: bool = True) -> hl.Table:
         & ~left_ht.sample_filters.release_related
     ).persist()
 
-    logger.info(
-        "Release sample counts:"
-        f"{left_ht.aggregate(hl.struct(release=hl.agg.count_where(left_ht.release)))}"
+    sample_counts = left_ht.aggregate(
+        hl.struct(release=hl.agg.count_where(left_ht.release), total=hl.agg.count())
     )
-    left_ht.describe()
-    left_ht.summarize()
-    logger.info(f"Final count: {left_ht.count()}")
+    logger.info(f"Release sample count: {sample_counts.release}")
+    if verbose:
+        left_ht.describe()
+    logger.info(f"Final count: {sample_counts.total}")
     logger.info("Complete")
 
     return left_ht
@@ -1000,12 +1162,17 @@ def main(args):
         ).write(sex.path, overwrite=args.overwrite)
 
     if args.compute_hard_filters:
-        compute_hard_filters(args.min_cov).write(
+        compute_hard_filters(args.min_cov, overwrite=args.overwrite).write(
             hard_filtered_samples.path, overwrite=args.overwrite
         )
 
     if args.compute_qc_mt:
-        compute_qc_mt().write(qc.path, overwrite=args.overwrite)
+        compute_qc_mt().write(qc.path, overwrite=args.overwrite, stage_locally=True)
+
+    # PC-relate and the inbreeding calculation both scan the full QC MT, so only read it from GCS once if running both
+    qc_mt = None
+    if args.run_pc_relate and args.calculate_inbreeding:
+        qc_mt = qc.mt().persist()
 
     if args.run_pc_relate or args.reannotate_relatedness:
         if args.run_pc_relate:
@@ -1013,9 +1180,11 @@ def main(args):
             logger.warning(
                 "PC-relate requires SSDs and doesn't work with preemptible workers!"
             )
-            qc_mt = qc.mt()
-            eig, scores, _ = hl.hwe_normalized_pca(
-                qc_mt.GT, k=10, compute_loadings=False
+            if qc_mt is None:
+                qc_mt = qc.mt()
+            # Use the randomized block Lanczos PCA, which needs fewer passes over the QC MT than hwe_normalized_pca
+            eig, scores, _ = hl._hwe_normalized_blanczos(
+                qc_mt.GT, k=10, compute_loadings=False, oversampling_param=10
             )
             scores = scores.checkpoint(
                 pc_relate_pca_scores.path,
@@ -1032,9 +1201,15 @@ def main(args):
             )
 
         else:
-            relatedness_ht = relatedness.ht().checkpoint(
-                "gs://gnomad-tmp/relatedness_ht_checkpoint.ht", overwrite=True
-            )  # Copy HT to temp location to overwrite annotation
+            # Copy HT to temp location to overwrite annotation, only keeping the PC-relate statistics since the
+            # relationship annotation is recomputed
+            relatedness_ht = (
+                relatedness.ht()
+                .select("kin", "ibd0", "ibd1", "ibd2")
+                .checkpoint(
+                    "gs://gnomad-tmp/relatedness_ht_checkpoint.ht", overwrite=True
+                )
+            )
         relatedness_ht = relatedness_ht.annotate(
             relationship=get_relationship_expr(
                 kin_expr=relatedness_ht.kin,
@@ -1059,30 +1234,33 @@ def main(args):
         rank_ht = compute_sample_rankings(
             use_qc_metrics_filters=False
         )  # QC metrics filters do not exist at this point
-        rank_ht = rank_ht.checkpoint(
+        rank_ht = rank_ht.naive_coalesce(SAMPLE_HT_N_PARTITIONS).checkpoint(
             pca_samples_rankings.path,
             overwrite=args.overwrite,
             _read_if_exists=not args.overwrite,
         )
-        filtered_samples = hl.literal(
-            rank_ht.aggregate(
-                hl.agg.filter(rank_ht.filtered, hl.agg.collect_as_set(rank_ht.s))
-            )
-        )  # TODO: don't localize once hail bug is fixed
+        filtered_samples = get_filtered_samples_expr(
+            rank_ht, args.localize_filtered_samples
+        )
         samples_to_drop = compute_related_samples_to_drop(
-            relatedness.ht(),
+            key_relatedness_by_sample_ids(relatedness.ht()),
             rank_ht,
             args.second_degree_kin_cutoff,
             filtered_samples=filtered_samples,
         )
-        samples_to_drop = samples_to_drop.key_by(s=samples_to_drop.s.s)
-        samples_to_drop.checkpoint(
+        samples_to_drop = samples_to_drop.naive_coalesce(
+            SAMPLE_HT_N_PARTITIONS
+        ).checkpoint(
             pca_related_samples_to_drop.path,
             overwrite=args.overwrite,
             _read_if_exists=not args.overwrite,
         )
         pop_pca_eigenvalues, pop_pca_scores_ht, pop_pca_loadings_ht = run_pca(
-            args.include_unreleasable_samples, args.n_pcs, samples_to_drop
+            args.include_unreleasable_samples,
+            args.n_pcs,
+            samples_to_drop,
+            q_iterations=args.pca_q_iterations,
+            oversampling_param=args.pca_oversampling_param,
         )
         pop_pca_scores_ht.write(
             ancestry_pca_scores(args.include_unreleasable_samples).path,
@@ -1115,51 +1293,71 @@ def main(args):
             n_pcs=n_pcs,
             withhold_prop=args.withhold_prop,
         )
-        pop_ht = pop_ht.checkpoint(
+        pop_ht = pop_ht.naive_coalesce(SAMPLE_HT_N_PARTITIONS).checkpoint(
             pop.path, overwrite=args.overwrite, _read_if_exists=not args.overwrite
         )
-        pop_ht.transmute(
-            **{f"PC{i + 1}": pop_ht.pca_scores[i] for i in range(n_pcs)}
-        ).export(pop_tsv_path())
+        pop_ht.transmute(**get_pc_struct_expr(pop_ht.pca_scores, n_pcs)).export(
+            pop_tsv_path()
+        )
 
         with hl.hadoop_open(pop_rf_path(), "wb") as out:
-            pickle.dump(pops_rf_model, out)
+            pickle.dump(pops_rf_model, out, protocol=pickle.HIGHEST_PROTOCOL)
 
     if args.calculate_inbreeding:
-        qc_mt = qc.mt()
+        if qc_mt is None:
+            qc_mt = qc.mt()
         pop_ht = pop.ht()
-        qc_mt = qc_mt.annotate_cols(pop=pop_ht[qc_mt.col_key].pop)
-        qc_mt = qc_mt.annotate_rows(
-            call_stats_by_pop=hl.agg.group_by(
-                qc_mt.pop, hl.agg.call_stats(qc_mt.GT, qc_mt.alleles)
+        inbreeding_mt = qc_mt.annotate_cols(pop=pop_ht[qc_mt.col_key].pop)
+        # Only keep the alt AF per pop and materialize it as a small rows HT, so the sample inbreeding pass is a
+        # single entry scan that looks up AFs instead of replaying the per-pop call stats aggregation
+        af_by_pop_ht = (
+            inbreeding_mt.annotate_rows(
+                af_by_pop=hl.agg.group_by(
+                    inbreeding_mt.pop,
+                    hl.agg.call_stats(inbreeding_mt.GT, inbreeding_mt.alleles).AF[1],
+                )
             )
+            .rows()
+            .select("af_by_pop")
+            .checkpoint("gs://gnomad-tmp/qc_mt_af_by_pop.ht", overwrite=True)
+        )
+        inbreeding_mt = inbreeding_mt.annotate_rows(
+            af_by_pop=af_by_pop_ht[inbreeding_mt.row_key].af_by_pop
         )
         inbreeding_ht = (
-            qc_mt.annotate_cols(
+            inbreeding_mt.annotate_cols(
                 inbreeding=hl.agg.inbreeding(
-                    qc_mt.GT, qc_mt.call_stats_by_pop[qc_mt.pop].AF[1]
+                    inbreeding_mt.GT, inbreeding_mt.af_by_pop[inbreeding_mt.pop]
                 )
             )
             .cols()
             .select("inbreeding")
         )
         inbreeding_ht.write(sample_inbreeding.path, overwrite=args.overwrite)
+        qc_mt.unpersist()
 
     if args.calculate_clinvar:
         mt = get_gnomad_v3_mt(
             split=True, key_by_locus_and_alleles=True, remove_hard_filtered_samples=True
         )
+        # Annotate the pathogenic status on the ClinVar HT so the MT only needs a single join
         clinvar_ht = clinvar.ht()
-        mt = mt.filter_rows(hl.is_defined(clinvar_ht[mt.row_key]))
-        mt = mt.checkpoint("gs://gnomad-tmp/clinvar_variants.mt", overwrite=True)
-        mt = mt.annotate_rows(
-            clinvar_path=hl.is_defined(
-                filter_to_clinvar_pathogenic(clinvar_ht)[mt.row_key]
-            )
+        clinvar_path_ht = filter_to_clinvar_pathogenic(clinvar_ht)
+        clinvar_ht = clinvar_ht.select(
+            clinvar_path=hl.is_defined(clinvar_path_ht[clinvar_ht.key])
         )
+        # clinvar_path is only missing for variants that are not in ClinVar
+        mt = mt.annotate_rows(clinvar_path=clinvar_ht[mt.row_key].clinvar_path)
+        mt = mt.filter_rows(hl.is_defined(mt.clinvar_path))
+        # Both counts are computed in a single pass over the non-ref entries
         clinvar_sample_ht = mt.select_cols(
-            n_clinvar=hl.agg.count_where(mt.GT.is_non_ref()),
-            n_clinvar_path=hl.agg.count_where(mt.GT.is_non_ref() & mt.clinvar_path),
+            **hl.agg.filter(
+                mt.GT.is_non_ref(),
+                hl.struct(
+                    n_clinvar=hl.agg.count(),
+                    n_clinvar_path=hl.agg.count_where(mt.clinvar_path),
+                ),
+            )
         ).cols()
         clinvar_sample_ht.write(sample_clinvar_count.path, overwrite=args.overwrite)
 
@@ -1175,6 +1373,12 @@ def main(args):
                 )
             )
 
+        # Both filtering methods use the same sample QC HT, so only compute it once if running both
+        if args.apply_regressed_filters and args.apply_stratified_filters:
+            sample_qc_ht = sample_qc_ht.checkpoint(
+                "gs://gnomad-tmp/sample_qc_with_inbreeding.ht", overwrite=True
+            )
+
         if args.apply_regressed_filters:
             n_pcs = args.regress_n_pcs
             apply_regressed_filters(
@@ -1183,41 +1387,34 @@ def main(args):
                 args.include_unreleasable_samples,
                 n_pcs,
             ).write(regressed_metrics.path, overwrite=args.overwrite)
-        else:
+        if args.apply_stratified_filters:
             apply_stratified_filters(sample_qc_ht, filtering_qc_metrics,).write(
                 stratified_metrics.path, overwrite=args.overwrite
             )
 
     if args.compute_related_samples_to_drop:
         rank_ht = compute_sample_rankings(use_qc_metrics_filters=True)
-        rank_ht = rank_ht.checkpoint(
+        rank_ht = rank_ht.naive_coalesce(SAMPLE_HT_N_PARTITIONS).checkpoint(
             release_samples_rankings.path,
             overwrite=args.overwrite,
             _read_if_exists=not args.overwrite,
         )
-        filtered_samples = hl.literal(
-            rank_ht.aggregate(
-                hl.agg.filter(rank_ht.filtered, hl.agg.collect_as_set(rank_ht.s))
-            )
-        )  # TODO: don't localize once hail bug is fixed
-        print(filtered_samples)
-        relatedness_ht = relatedness.ht()
-        relatedness_ht = relatedness_ht.key_by(
-            i=relatedness_ht.i.s, j=relatedness_ht.j.s
+        filtered_samples = get_filtered_samples_expr(
+            rank_ht, args.localize_filtered_samples
         )
         samples_to_drop = compute_related_samples_to_drop(
-            relatedness_ht,
+            key_relatedness_by_sample_ids(relatedness.ht()),
             rank_ht,
             args.second_degree_kin_cutoff,
             filtered_samples=filtered_samples,
         )
-        samples_to_drop.write(
+        samples_to_drop.naive_coalesce(SAMPLE_HT_N_PARTITIONS).write(
             release_related_samples_to_drop.path, overwrite=args.overwrite
         )
 
     if args.generate_metadata:
-        meta_ht = generate_metadata(args.regressed_metrics_outlier)
-        meta_ht.checkpoint(
+        meta_ht = generate_metadata(args.regressed_metrics_outlier, args.verbose)
+        meta_ht = meta_ht.naive_coalesce(SAMPLE_HT_N_PARTITIONS).checkpoint(
             meta.path, overwrite=args.overwrite, _read_if_exists=not args.overwrite
         )
         n_pcs = meta_ht.aggregate(
@@ -1226,10 +1423,7 @@ def main(args):
 
         meta_ht = meta_ht.annotate(
             population_inference=meta_ht.population_inference.transmute(
-                **{
-                    f"PC{i + 1}": meta_ht.population_inference.pca_scores[i]
-                    for i in range(n_pcs)
-                }
+                **get_pc_struct_expr(meta_ht.population_inference.pca_scores, n_pcs)
             ),
             hard_filters=hl.or_missing(
                 hl.len(meta_ht.sample_filters.hard_filters) > 0,
@@ -1326,6 +1520,11 @@ if __name__ == "__main__":
         help="Flags related samples to drop",
         action="store_true",
     )
+    parser.add_argument(
+        "--localize_filtered_samples",
+        help="Collect the filtered samples to the driver before computing related samples to drop. Fallback for Hail versions that fail to use the set without localizing it.",
+        action="store_true",
+    )
     parser.add_argument(
         "--min_related_hard_filter",
         help="Minimum number of relateds to have to get hard-filterd",
@@ -1339,6 +1538,18 @@ if __name__ == "__main__":
         default=30,
         type=int,
     )
+    parser.add_argument(
+        "--pca_q_iterations",
+        help="Number of power iterations for the randomized ancestry PCA",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--pca_oversampling_param",
+        help="Number of extra dimensions used by the randomized ancestry PCA to improve accuracy",
+        default=10,
+        type=int,
+    )
     parser.add_argument(
         "--include_unreleasable_samples",
         help="Includes unreleasable samples for computing PCA",
@@ -1415,5 +1626,10 @@ if __name__ == "__main__":
         help="Should metadata HT use regression outlier model.",
         action="store_true",
     )
+    parser.add_argument(
+        "--verbose",
+        help="Report sample count mismatches for each join when generating the metadata HT and describe the final HT. Requires additional passes over each Table.",
+        action="store_true",
+    )
 
     main(parser.parse_args())
@@ -1,8 +1,10 @@
 import argparse
+import copy
+import hashlib
 import json
 import logging
 import sys
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 import uuid
 
 import hail as hl
@@ -38,6 +40,7 @@ from gnomad_qc.v3.resources.variant_qc import (
     get_rf_model_path,
     get_rf_result,
     get_rf_training,
+    rf_annotation_sidecar,
     rf_run_path,
 )
 
@@ -45,7 +48,7 @@ logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
 logger = logging.getLogger("variant_qc_random_forest")
 logger.setLevel(logging.INFO)
 
-FEATURES = [
+FEATURES = (
     "allele_type",
     "AS_MQRankSum",
     "AS_pab_max",
@@ -55,19 +58,100 @@ FEATURES = [
     "InbreedingCoeff",
     "n_alt_alleles",
     "variant_type",
-]
+)
 INBREEDING_COEFF_HARD_CUTOFF = -0.3
-INFO_FEATURES = [
+INFO_FEATURES = (
     "AS_MQRankSum",
     "AS_pab_max",
     "AS_QD",
     "AS_ReadPosRankSum",
     "AS_SOR",
-]
+)
 LABEL_COL = "rf_label"
 PREDICTION_COL = "rf_prediction"
 TRAIN_COL = "rf_train"
-TRUTH_DATA = ["hapmap", "omni", "mills", "kgp_phase1_hc"]
+TRUTH_DATA = ("hapmap", "omni", "mills", "kgp_phase1_hc")
+
+_hail_initialized = False
+
+
+def _ensure_hail() -> None:
+    """
+    Initializes Hail the first time it is needed so that invocations without any Hail work don't pay the JVM startup cost.
+
+    :return: Nothing
+    """
+    global _hail_initialized
+    if not _hail_initialized:
+        hl.init(log="/variant_qc_random_forest.log")
+        _hail_initialized = True
+
+
+def get_rf_sidecar_inputs() -> Dict[str, str]:
+    """
+    Gets the paths of the QC allele counts, trio stats and allele data Tables merged by `build_rf_sidecar`, along
+    with the modification times of their _SUCCESS files.
+
+    The truth data Tables are versioned gnomAD reference resources and are not tracked.
+
+    :return: Dictionary of input Table path to modification time
+    """
+    return {
+        resource.path: str(
+            hl.hadoop_stat(f"{resource.path}/_SUCCESS")["modification_time"]
+        )
+        for resource in [qc_ac, fam_stats, allele_data]
+    }
+
+
+def rf_sidecar_is_current() -> bool:
+    """
+    Checks whether the RF annotation sidecar Table exists and was built from the current versions of its inputs.
+
+    :return: Whether the sidecar Table can be used as is
+    """
+    if not hl.hadoop_exists(f"{rf_annotation_sidecar.path}/_SUCCESS"):
+        logger.info("RF annotation sidecar Table not found...")
+        return False
+
+    if hl.eval(rf_annotation_sidecar.ht().sidecar_inputs) != get_rf_sidecar_inputs():
+        logger.info("RF annotation sidecar Table is older than its input Tables...")
+        return False
+
+    return True
+
+
+def build_rf_sidecar() -> hl.Table:
+    """
+    Merges the trio stats, truth data, allele data and QC allele counts Tables into a single Table.
+
+    The sidecar is keyed by locus and alleles and only needs to be rebuilt when one of its inputs changes, so
+    `create_rf_ht` can annotate with one lookup instead of four. The paths and modification times of the inputs are
+    stored in the `sidecar_inputs` global, see `get_rf_sidecar_inputs`.
+
+    :return: Table with trio stats, truth data, allele data and QC allele count annotations
+    :rtype: Table
+    """
+    trio_stats_ht = fam_stats.ht()
+    trio_stats_ht = trio_stats_ht.select(
+        *[
+            f"{field}_{group}"
+            for field in ["n_transmitted", "ac_children"]
+            for group in ["raw", "adj"]
+        ]
+    )
+    truth_data_ht = get_truth_ht()
+    allele_data_ht = allele_data.ht()
+
+    ht = qc_ac.ht()
+    ht = ht.annotate(
+        **trio_stats_ht[ht.key],
+        **truth_data_ht[ht.key],
+        **allele_data_ht[ht.key].allele_data,
+    )
+    ht = ht.annotate_globals(sidecar_inputs=get_rf_sidecar_inputs())
+
+    return ht
 
 
 def create_rf_ht(
@@ -75,6 +159,7 @@ def create_rf_ht(
     adj: bool = False,
     n_partitions: int = 5000,
     checkpoint_path: Optional[str] = None,
+    verbose_summary: bool = False,
 ) -> hl.Table:
     """
     Creates a Table with all necessary annotations for the random forest model.
@@ -100,7 +185,8 @@ def create_rf_ht(
     :param bool impute_features: Whether to impute features using feature medians (this is done by variant type)
     :param str adj: Whether to use adj genotypes
     :param int n_partitions: Number of partitions to use for final annotated table
-    :param str checkpoint_path: Optional checkpoint path for the Table before median imputation and/or aggregate summary
+    :param str checkpoint_path: Optional checkpoint path for the Table before median imputation and/or aggregate summary. Not used when neither is performed
+    :param bool verbose_summary: Whether to show a summary of the truth data annotations, which requires a full pass over the Table
     :return: Hail Table ready for RF
     :rtype: Table
     """
@@ -108,8 +194,10 @@ def create_rf_ht(
     group = "adj" if adj else "raw"
 
     ht = get_info(split=True).ht()
-    ht = ht.transmute(**ht.info)
-    ht = ht.select("lowqual", "AS_lowqual", "FS", "MQ", "QD", *INFO_FEATURES)
+    ht = ht.select("AS_lowqual", **ht.info.select("FS", "MQ", "QD", *INFO_FEATURES))
+    ht = ht.filter(~ht.AS_lowqual)
+    # Coalesce before the joins so they run at the final partition count
+    ht = ht.naive_coalesce(n_partitions)
 
     inbreeding_ht = get_freq().ht()
     inbreeding_ht = inbreeding_ht.select(
@@ -119,25 +207,14 @@ def create_rf_ht(
             inbreeding_ht.InbreedingCoeff,
         )
     )
-    trio_stats_ht = fam_stats.ht()
-    trio_stats_ht = trio_stats_ht.select(
-        f"n_transmitted_{group}", f"ac_children_{group}"
-    )
-
-    truth_data_ht = get_truth_ht()
-    allele_data_ht = allele_data.ht()
-    allele_counts_ht = qc_ac.ht()
+    sidecar_ht = rf_annotation_sidecar.ht()
+    sidecar_ht = sidecar_ht.filter(sidecar_ht[f"ac_qc_samples_{group}"] > 0)
 
     logger.info("Annotating Table with all columns from multiple annotation Tables")
-    ht = ht.annotate(
-        **inbreeding_ht[ht.key],
-        **trio_stats_ht[ht.key],
-        **truth_data_ht[ht.key],
-        **allele_data_ht[ht.key].allele_data,
-        **allele_counts_ht[ht.key],
-    )
-    # Filter to only variants found in high quality samples and are not lowqual
-    ht = ht.filter((ht[f"ac_qc_samples_{group}"] > 0) & ~ht.AS_lowqual)
+    # Filter to only variants found in high quality samples before joining the remaining annotations
+    ht = ht.annotate(**sidecar_ht[ht.key])
+    ht = ht.filter(hl.is_defined(ht[f"ac_qc_samples_{group}"]))
+    ht = ht.annotate(**inbreeding_ht[ht.key])
     ht = ht.select(
         "a_index",
         "was_split",
@@ -154,18 +231,19 @@ def create_rf_ht(
         ac_qc_samples_unrelated_raw=ht.ac_qc_samples_unrelated_raw,
     )
 
-    ht = ht.repartition(n_partitions, shuffle=False)
-    if checkpoint_path:
+    # Only checkpoint when the Table is aggregated over before the caller writes it
+    if checkpoint_path and (impute_features or verbose_summary):
         ht = ht.checkpoint(checkpoint_path, overwrite=True)
 
     if impute_features:
         ht = median_impute_features(ht, {"variant_type": ht.variant_type})
 
-    summary = ht.group_by("omni", "mills", "transmitted_singleton",).aggregate(
-        n=hl.agg.count()
-    )
-    logger.info("Summary of truth data annotations:")
-    summary.show(20)
+    if verbose_summary:
+        summary = ht.group_by("omni", "mills", "transmitted_singleton").aggregate(
+            n=hl.agg.count()
+        )
+        logger.info("Summary of truth data annotations:")
+        summary.show(20)
 
     return ht
 
@@ -197,7 +275,7 @@ def train_rf(
     :param test_intervals: Specified interval(s) will be held out for testing and evaluation only. (default to "chr20")
     :return: `ht` annotated with training information and the RF model
     """
-    features = FEATURES
+    features = list(FEATURES)
     test_intervals = test_intervals
     if no_inbreeding_coeff:
         logger.info("Removing InbreedingCoeff from list of features...")
@@ -225,12 +303,15 @@ def train_rf(
             hl.parse_locus_interval(x, reference_genome="GRCh38")
             for x in test_intervals
         ]
+    test_intervals_expr = hl.literal(test_intervals)
 
     ht = ht.annotate(tp=tp_expr, fp=fp_expr)
 
     if filter_centromere_telomere:
         logger.info("Filtering centromeres and telomeres from HT...")
-        rf_ht = ht.filter(~hl.is_defined(telomeres_and_centromeres.ht()[ht.locus]))
+        rf_ht = hl.filter_intervals(
+            ht, telomeres_and_centromeres.ht().interval.collect(), keep=False
+        )
     else:
         rf_ht = ht
 
@@ -242,7 +323,7 @@ def train_rf(
         fp_to_tp=fp_to_tp,
         num_trees=num_trees,
         max_depth=max_depth,
-        test_expr=hl.literal(test_intervals).any(
+        test_expr=test_intervals_expr.any(
             lambda interval: interval.contains(rf_ht.locus)
         ),
     )
@@ -253,19 +334,44 @@ def train_rf(
     return ht, rf_model
 
 
+def write_rf_runs(rf_runs: Dict) -> None:
+    """
+    Writes the RF run list to the RF runs JSON file.
+
+    :param rf_runs: Dictionary of RF runs keyed by model ID
+    :return: Nothing
+    """
+    rf_runs_json = json.dumps(rf_runs)
+    with hl.hadoop_open(rf_run_path(), "w") as f:
+        f.write(rf_runs_json)
+
+
 def main(args):
-    hl.init(log="/variant_qc_random_forest.log")
+    rf_runs = None
+    if args.list_rf_runs or args.train_rf:
+        _ensure_hail()
+        rf_runs = get_rf_runs(rf_run_path())
 
     if args.list_rf_runs:
         logger.info(f"RF runs:")
-        pretty_print_runs(get_rf_runs(rf_run_path()))
+        # pretty_print_runs pops the test results, so print a copy to keep them for --train_rf
+        pretty_print_runs(copy.deepcopy(rf_runs))
+
+    if args.build_rf_sidecar:
+        _ensure_hail()
+        build_rf_sidecar().write(rf_annotation_sidecar.path, overwrite=args.overwrite)
 
     if args.annotate_for_rf:
+        _ensure_hail()
+        if not args.build_rf_sidecar and not rf_sidecar_is_current():
+            logger.info("Building RF annotation sidecar Table...")
+            build_rf_sidecar().write(rf_annotation_sidecar.path, overwrite=True)
         ht = create_rf_ht(
             impute_features=args.impute_features,
             adj=args.adj,
             n_partitions=args.n_partitions,
             checkpoint_path=get_checkpoint_path("rf_annotation"),
+            verbose_summary=args.verbose_summary,
         )
         ht.write(
             get_rf_annotations(args.adj).path, overwrite=args.overwrite,
@@ -273,11 +379,40 @@ def main(args):
         logger.info(f"Completed annotation wrangling for random forests model training")
 
     if args.train_rf:
+        _ensure_hail()
         model_id = f"rf_{str(uuid.uuid4())[:8]}"
-        rf_runs = get_rf_runs(rf_run_path())
         while model_id in rf_runs:
             model_id = f"rf_{str(uuid.uuid4())[:8]}"
 
+        # Hash the training parameters to flag runs repeating the configuration of an earlier run
+        training_args = {
+            arg: getattr(args, arg)
+            for arg in [
+                "adj",
+                "fp_to_tp",
+                "test_intervals",
+                "num_trees",
+                "max_depth",
+                "vqsr_training",
+                "vqsr_model_id",
+                "no_transmitted_singletons",
+                "no_inbreeding_coeff",
+                "filter_centromere_telomere",
+            ]
+        }
+        training_args_hash = hashlib.blake2b(
+            json.dumps(training_args, sort_keys=True).encode()
+        ).hexdigest()
+        matching_runs = [
+            run_id
+            for run_id, run_data in rf_runs.items()
+            if run_data.get("training_args_hash") == training_args_hash
+        ]
+        if matching_runs:
+            logger.warning(
+                f"RF runs {matching_runs} used the same training parameters as this run."
+            )
+
         ht, rf_model = train_rf(
             get_rf_annotations(args.adj).ht(),
             fp_to_tp=args.fp_to_tp,
@@ -296,6 +431,12 @@ def main(args):
         )
 
         logger.info("Adding run to RF run list")
+        rf_globals = hl.eval(
+            hl.struct(
+                features_importance=ht.features_importance,
+                test_results=ht.test_results,
+            )
+        )
         rf_runs[model_id] = get_run_data(
             input_args={
                 "transmitted_singletons": None
@@ -306,25 +447,27 @@ def main(args):
                 "filter_centromere_telomere": args.filter_centromere_telomere,
             },
             test_intervals=args.test_intervals,
-            features_importance=hl.eval(ht.features_importance),
-            test_results=hl.eval(ht.test_results),
+            features_importance=rf_globals.features_importance,
+            test_results=rf_globals.test_results,
         )
-
-        with hl.hadoop_open(rf_run_path(), "w") as f:
-            json.dump(rf_runs, f)
+        rf_runs[model_id]["training_args_hash"] = training_args_hash
 
         logger.info("Saving RF model")
         save_model(
-            rf_model, get_rf_model_path(model_id=model_id), overwrite=args.overwrite,
+            rf_model, get_rf_model_path(model_id=model_id), overwrite=args.overwrite
         )
+        write_rf_runs(rf_runs)
 
     else:
         model_id = args.model_id
 
     if args.apply_rf:
+        _ensure_hail()
         logger.info(f"Applying RF model {model_id}...")
-        rf_model = load_model(get_rf_model_path(model_id=model_id))
-        ht = get_rf_training(model_id=model_id).ht()
+        # Reuse the training Table checkpoint and model from --train_rf when run in the same invocation
+        if not args.train_rf:
+            rf_model = load_model(get_rf_model_path(model_id=model_id))
+            ht = get_rf_training(model_id=model_id).ht()
         features = hl.eval(ht.features)
         ht = apply_rf_model(ht, rf_model, features, label=LABEL_COL)
 
@@ -334,10 +477,11 @@ def main(args):
             get_rf_result(model_id=model_id).path, overwrite=args.overwrite,
         )
 
-        ht_summary = ht.group_by(
-            "tp", "fp", TRAIN_COL, LABEL_COL, PREDICTION_COL
-        ).aggregate(n=hl.agg.count())
-        ht_summary.show(n=20)
+        if args.verbose_summary:
+            ht_summary = ht.group_by(
+                "tp", "fp", TRAIN_COL, LABEL_COL, PREDICTION_COL
+            ).aggregate(n=hl.agg.count())
+            ht_summary.show(n=20)
 
 
 if __name__ == "__main__":
@@ -356,12 +500,23 @@ if __name__ == "__main__":
         required=False,
     )
 
+    parser.add_argument(
+        "--verbose_summary",
+        help="Show summary counts of the annotated and RF result Tables. Each summary requires a full pass over the Table.",
+        action="store_true",
+    )
+
     actions = parser.add_argument_group("Actions")
     actions.add_argument(
         "--list_rf_runs",
         help="Lists all previous RF runs, along with their model ID, parameters and testing results.",
         action="store_true",
     )
+    actions.add_argument(
+        "--build_rf_sidecar",
+        help="Merges the trio stats, truth data, allele data and QC allele counts Tables used by --annotate_for_rf into a single Table. Also rebuilt by --annotate_for_rf when missing or older than its inputs.",
+        action="store_true",
+    )
     actions.add_argument(
         "--annotate_for_rf",
         help="Creates an annotated HT with features for RF.",